@@ -1,25 +1,69 @@
 # utils_vtt.py
 # 简单的 vtt 读写工具。支持读取 whisper 的 segments 写入 VTT，
 # 以及反向将 vtt 解析为 cues 列表：[{start, end, text}]
-from typing import List, Dict, Union
+from typing import List, Dict, Tuple, Union
+from functools import lru_cache
 import re
 from pathlib import Path
+import numpy as np
 
 PathLike = Union[str, Path]
 
+# cue block written per cue: id, start --> end, text, blank line
+_CUE_TMPL = "%d\n%s --> %s\n%s\n\n"
+
+# one cue per match: timecode line (HH:MM:SS.mmm or MM:SS.mmm with . or ,, cue settings ignored)
+# followed by body lines up to the next blank line. id lines before the timecode are skipped
+# naturally, NOTE/STYLE/REGION blocks never match since they have no timecode line.
+# timecodes are captured as h (optional), m, s, ms digit groups so they can be converted in bulk.
+_CUE_RE = re.compile(
+    r'^[ \t]*(?:(\d{2}):)?(\d{2}):(\d{2})[.,](\d{3})[ \t]*-->[ \t]*'
+    r'(?:(\d{2}):)?(\d{2}):(\d{2})[.,](\d{3})[^\n]*(?:\n|\Z)'
+    r'((?:[^\n]+(?:\n|\Z))*)',
+    re.MULTILINE,
+)
+
+_hms_kernel = None
+
+
+def _hms_to_seconds(fields):
+    """
+    fields: int64 array of shape (n, 8), one row per cue: start h, m, s, ms, end h, m, s, ms.
+    Returns (starts, ends) as float64 seconds. Compiled with numba on first use.
+    """
+    n = fields.shape[0]
+    starts = np.empty(n, np.float64)
+    ends = np.empty(n, np.float64)
+    for i in range(n):
+        starts[i] = (fields[i, 0] * 3600000 + fields[i, 1] * 60000 + fields[i, 2] * 1000 + fields[i, 3]) / 1000.0
+        ends[i] = (fields[i, 4] * 3600000 + fields[i, 5] * 60000 + fields[i, 6] * 1000 + fields[i, 7]) / 1000.0
+    return starts, ends
+
+
+def _get_hms_kernel():
+    """numba is imported lazily so that only VTT reading pays for (and requires) it."""
+    global _hms_kernel
+    if _hms_kernel is None:
+        from numba import njit
+        # no 'arcp'/'afn' in fastmath: /1000.0 must stay an exact division, not a reciprocal multiply
+        _hms_kernel = njit(cache=True, fastmath={'nnan', 'ninf', 'nsz', 'contract'},
+                           boundscheck=False)(_hms_to_seconds)
+    return _hms_kernel
+
 
 def format_time_vtt(ts: float) -> str:
     """Format seconds (float) to WebVTT timestamp: HH:MM:SS.mmm"""
-    try:
-        ts_f = float(ts)
-    except Exception:
-        ts_f = 0.0
-    if ts_f < 0:
-        ts_f = 0.0
-    h = int(ts_f // 3600)
-    m = int((ts_f % 3600) // 60)
-    s = ts_f % 60
-    return f"{h:02d}:{m:02d}:{s:06.3f}"  # VTT uses dot as decimal separator
+    return _fmt_ms(max(0, int(round(ts * 1000))))
+
+
+@lru_cache(maxsize=8192)
+def _fmt_ms(ms: int) -> str:
+    """Format non-negative integer milliseconds as HH:MM:SS.mmm (cached: cue boundaries repeat often)."""
+    # integer millisecond arithmetic: no float modulo rounding, no float formatting
+    s, ms = divmod(ms, 1000)
+    m, s = divmod(s, 60)
+    h, m = divmod(m, 60)
+    return f"{h:02d}:{m:02d}:{s:02d}.{ms:03d}"  # VTT uses dot as decimal separator
 
 
 def srt_time(ts: float) -> str:
@@ -32,100 +76,58 @@ def write_vtt_from_segments(path: PathLike, segments: List[Dict]) -> None:
     Write a WebVTT file from whisper-style segments.
     Each segment expected to have keys: 'start', 'end', 'text'.
     """
-    p = Path(path)
-    p.parent.mkdir(parents=True, exist_ok=True)
-    with p.open('w', encoding='utf-8') as f:
-        f.write("WEBVTT\n\n")
-        for idx, seg in enumerate(segments):
-            start = float(seg.get('start', 0.0))
-            end = float(seg.get('end', start + 0.5))
-            text = str(seg.get('text', '')).strip()
-            # Include a numeric cue id for clarity (optional in VTT)
-            f.write(f"{idx}\n")
-            f.write(f"{format_time_vtt(start)} --> {format_time_vtt(end)}\n")
-            f.write(text + "\n\n")
+    write_vtt_cues_soa(path, *_cues_to_soa(segments))
 
 
-def read_vtt_cues(path: PathLike) -> List[Dict]:
+def read_vtt_cues_soa(path: PathLike) -> Tuple[np.ndarray, np.ndarray, List[str]]:
     """
-    Read a WebVTT file and return list of cues:
-    [{'start': float, 'end': float, 'text': str}, ...]
+    Read a WebVTT file as parallel arrays: (starts, ends, texts).
+    starts/ends are float64 arrays in seconds, texts is a list of str.
     This parser is permissive and supports:
       - HH:MM:SS.mmm  (e.g. 00:01:23.456)
       - MM:SS.mmm     (e.g. 01:23.456)
       - decimal separator '.' or ','
     It ignores NOTE blocks and will skip parts without valid timecode.
     """
-    p = Path(path)
-    raw = p.read_text(encoding='utf-8')
+    # utf-8-sig drops a leading BOM while decoding
+    raw = Path(path).read_bytes().decode('utf-8-sig')
 
-    # remove BOM if present
-    if raw.startswith('\ufeff'):
-        raw = raw[1:]
-
-    # normalize line endings
-    raw = raw.replace('\r\n', '\n').replace('\r', '\n')
+    # normalize line endings (skip both passes for the common LF-only file)
+    if '\r' in raw:
+        raw = raw.replace('\r\n', '\n').replace('\r', '\n')
 
     # strip initial WEBVTT header if present (and any header metadata until a blank line)
-    raw = re.sub(r'^WEBVTT.*?\n\n', '', raw, count=1, flags=re.DOTALL)
-
-    # split cues by two or more newlines
-    parts = re.split(r'\n{2,}', raw.strip())
-
-    cues: List[Dict] = []
-    # regex to capture start and end (supports HH:MM:SS.mmm or MM:SS.mmm with . or ,)
-    time_re = re.compile(
-        r'(?P<start>\d{2}:\d{2}:\d{2}[.,]\d{3}|\d{2}:\d{2}[.,]\d{3})\s*-->\s*'
-        r'(?P<end>\d{2}:\d{2}:\d{2}[.,]\d{3}|\d{2}:\d{2}[.,]\d{3})'
-    )
-
-    for part in parts:
-        part = part.strip()
-        if not part:
-            continue
-        # ignore NOTE blocks
-        if part.upper().startswith('NOTE'):
-            continue
-
-        lines = part.splitlines()
-        # find the line containing '-->'
-        time_line_idx = None
-        for i, ln in enumerate(lines):
-            if '-->' in ln:
-                time_line_idx = i
-                break
-        if time_line_idx is None:
-            # no timecode in this block
-            continue
-
-        time_line = lines[time_line_idx]
-        m = time_re.search(time_line)
-        if not m:
-            # try to normalize tabs/spaces and retry
-            tl = time_line.replace('\t', ' ').strip()
-            m = time_re.search(tl)
-            if not m:
-                continue
-
-        start = parse_time(m.group('start'))
-        end = parse_time(m.group('end'))
-
-        # text is all lines except numeric id lines and the time line
-        text_lines = []
-        for j, ln in enumerate(lines):
-            if j == time_line_idx:
-                continue
-            # skip numeric id-only lines
-            if re.fullmatch(r'\d+', ln.strip()):
-                continue
-            # skip some header-like lines (STYLE/REGION) — keep content lines
-            if ln.strip().upper().startswith('STYLE') or ln.strip().upper().startswith('REGION'):
-                continue
-            text_lines.append(ln)
-        text = '\n'.join(text_lines).strip()
-        cues.append({'start': start, 'end': end, 'text': text})
-
-    return cues
+    if raw.startswith('WEBVTT'):
+        i = raw.find('\n\n')
+        if i != -1:
+            raw = raw[i + 2:]
+
+    rows = []
+    texts: List[str] = []
+    for m in _CUE_RE.finditer(raw):
+        sh, sm, ss, sms, eh, em, es, ems, body = m.groups()
+        rows.append((sh or '0', sm, ss, sms, eh or '0', em, es, ems))
+        texts.append(body.strip())
+    if not rows:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64), texts
+
+    # digit strings -> int64 in one numpy pass, then one jitted call for all cues
+    fields = np.array(rows).astype(np.int64)
+    starts, ends = _get_hms_kernel()(fields)
+    return starts, ends, texts
+
+
+def read_vtt_cues(path: PathLike) -> List[Dict]:
+    """
+    Read a WebVTT file and return list of cues:
+    [{'start': float, 'end': float, 'text': str}, ...]
+    Thin adapter over read_vtt_cues_soa.
+    """
+    starts, ends, texts = read_vtt_cues_soa(path)
+    return [
+        {'start': start, 'end': end, 'text': text}
+        for start, end, text in zip(starts.tolist(), ends.tolist(), texts)
+    ]
 
 
 def parse_time(tstr: str) -> float:
@@ -159,17 +161,43 @@ def write_vtt_cues(path: PathLike, cues: List[Dict]) -> None:
     """
     Write a list of cues (dicts with 'start','end','text') to a .vtt file.
     """
-    p = Path(path)
-    p.parent.mkdir(parents=True, exist_ok=True)
-    with p.open('w', encoding='utf-8') as f:
-        f.write("WEBVTT\n\n")
-        for idx, c in enumerate(cues):
-            start = float(c.get('start', 0.0))
-            end = float(c.get('end', start + 0.5))
-            text = str(c.get('text', '')).strip()
-            f.write(f"{idx}\n")
-            f.write(f"{format_time_vtt(start)} --> {format_time_vtt(end)}\n")
-            f.write(text + "\n\n")
+    write_vtt_cues_soa(path, *_cues_to_soa(cues))
+
+
+def write_vtt_cues_soa(path: PathLike, starts: np.ndarray, ends: np.ndarray, texts: List[str]) -> None:
+    """
+    Write cues given as parallel arrays (starts, ends in seconds, texts) to a .vtt file.
+    """
+    # build the whole file in memory and write it once
+    starts = np.asarray(starts, dtype=np.float64).tolist()
+    ends = np.asarray(ends, dtype=np.float64).tolist()
+    out = ["WEBVTT\n\n"]
+    for idx, (start, end, text) in enumerate(zip(starts, ends, texts)):
+        start_str = format_time_vtt(start)
+        end_str = format_time_vtt(end)
+        text = str(text).strip()
+        # Include a numeric cue id for clarity (optional in VTT)
+        out.append(_CUE_TMPL % (idx, start_str, end_str, text))
+    _write_vtt(Path(path), ''.join(out))
+
+
+def _write_vtt(path: Path, header_and_body: str) -> None:
+    """Write the full VTT text; the parent directory is only created if the first write fails."""
+    data = header_and_body.encode('utf-8')
+    try:
+        path.write_bytes(data)
+    except FileNotFoundError:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+
+
+def _cues_to_soa(cues: List[Dict]) -> Tuple[np.ndarray, np.ndarray, List[str]]:
+    """Convert dict cues/segments to (starts, ends, texts); missing end defaults to start + 0.5."""
+    starts = np.fromiter((float(c.get('start', 0.0)) for c in cues), dtype=np.float64, count=len(cues))
+    ends = np.fromiter((float(c.get('end', start + 0.5)) for c, start in zip(cues, starts.tolist())),
+                       dtype=np.float64, count=len(cues))
+    texts = [str(c.get('text', '')) for c in cues]
+    return starts, ends, texts
 
 
 if __name__ == "__main__":
@@ -9,8 +9,7 @@
     * 利用SEGMENT_LENGTH参数控制每片长度，默认30秒
     * 利用OVERLAP参数控制重叠长度，默认5秒
     * VTT 最终合并去重（还需要改进）
-- 临时切片存放在 temp/，处理完一个文件后自动清理
-- 后续将临时切片改为numpy直接输入到whisper,减少文件io
+- 切片直接转为 16kHz 单声道 float32 numpy 数组输入 whisper，不再写临时文件
 """
 import os
 import argparse
@@ -19,13 +18,17 @@ import whisper
 from utils_vtt import write_vtt_from_segments
 from tqdm import tqdm
 import re
-from pydub import AudioSegment
-import shutil
+from math import gcd
+import numpy as np
+import soundfile
+from scipy.signal import resample_poly
+from concurrent.futures import ThreadPoolExecutor
+import torch
+from whisper.audio import HOP_LENGTH, N_FRAMES, N_SAMPLES
 
 INPUT_DIR = Path("inputs")
 SCRIPT_DIR = Path("script_jp")
 OUT_DIR = Path("outputs")
-TEMP_DIR = Path("temp")
 
 # 合并短段阈值（秒）
 MERGE_SHORT_THRESHOLD = 1.0  # 1秒以内的短字幕
@@ -33,86 +36,306 @@ MERGE_SHORT_THRESHOLD = 1.0  # 1秒以内的短字幕
 # 音频切片参数
 SEGMENT_LENGTH = 30 * 1000  # 单位毫秒
 OVERLAP = 5 * 1000          # 重叠 5 秒
+SAMPLE_RATE = 16000         # whisper 输入采样率
+DECODE_BATCH_SIZE = 2      # GPU 上每次 decode 的 30 秒窗口数（默认值，可用 --batch-size 调整）
+NO_SPEECH_THRESHOLD = 0.6  # no_speech 概率高于此值且平均 logprob 低于 LOGPROB_THRESHOLD 时视为静音
+LOGPROB_THRESHOLD = -1.0
+TIME_PRECISION = 2 * HOP_LENGTH / SAMPLE_RATE  # 一个时间戳 token 对应的秒数（0.02）
 
 
 def merge_short_segments(segments):
     if not segments:
         return []
-    merged = [segments[0]]
+    merged = []
+    cur = dict(segments[0])
+    # 连续短段的文本先收集，遇到合并边界再一次性拼接，避免反复 strip 和拼接越来越长的字符串
+    cur_text_parts = [cur['text'].strip()]
     for seg in segments[1:]:
-        prev = merged[-1]
         duration = seg['end'] - seg['start']
         if duration < MERGE_SHORT_THRESHOLD:
-            prev['end'] = seg['end']
-            prev['text'] = (prev['text'].strip() + ' ' + seg['text'].strip()).strip()
+            cur['end'] = seg['end']
+            cur_text_parts.append(seg['text'].strip())
         else:
-            merged.append(seg)
+            cur['text'] = ' '.join(t for t in cur_text_parts if t)
+            merged.append(cur)
+            cur = dict(seg)
+            cur_text_parts = [seg['text'].strip()]
+    cur['text'] = ' '.join(t for t in cur_text_parts if t)
+    merged.append(cur)
     return merged
 
 
-def slice_audio(audio: AudioSegment):
+def slice_audio(audio: np.ndarray):
     """
-    将音频切成多片，每片 SEGMENT_LENGTH，重叠 OVERLAP 毫秒
-    返回 [(start_ms, end_ms, AudioSegment), ...]
+    将 16kHz 单声道音频切成多片，每片 SEGMENT_LENGTH，重叠 OVERLAP 毫秒
+    每片恰好一个 whisper 30 秒窗口，步长为 SEGMENT_LENGTH - OVERLAP
+    逐个产出 (start_sample, end_sample, audio[start_sample:end_sample])，切片为原数组的视图，不拷贝
     """
-    slices = []
+    seg_len = SEGMENT_LENGTH * SAMPLE_RATE // 1000
+    overlap = OVERLAP * SAMPLE_RATE // 1000
     length = len(audio)
     start = 0
     while start < length:
-        end = start + SEGMENT_LENGTH
-        if start != 0:
-            start -= OVERLAP  # 重叠前 5 秒
-        end = min(end, length)
-        slices.append((start, end, audio[start:end]))
-        start += SEGMENT_LENGTH
-    return slices
+        end = min(start + seg_len, length)
+        yield start, end, audio[start:end]
+        if end == length:
+            break
+        start += seg_len - overlap
 
 
-def transcribe_slice(model, audio_slice: AudioSegment, slice_idx, wav_stem, language='ja'):
+def to_fp16(model):
+    """
+    在 GPU 上一次性把模型权重转为 FP16，避免 whisper 每次前向都把 FP32 权重临时转换成输入精度
+    LayerNorm 保持 FP32：whisper 的 LayerNorm 会先把输入转为 float 再计算，半精度权重会导致类型不匹配
+    """
+    model.half()
+    for module in model.modules():
+        if isinstance(module, torch.nn.LayerNorm):
+            module.float()
+    return model
+
+
+def transcribe_slice(model, audio_slice: np.ndarray, language='ja'):
     """
     whisper在长文件输入时，当某个段落空白过长，会认为已经结束，导致后续内容无法识别，所以引入切片机制
+    audio_slice 为 16kHz 单声道 float32 数组，直接交给 whisper，无需临时文件
     """
-    TEMP_DIR.mkdir(parents=True, exist_ok=True)
-    tmp_path = TEMP_DIR / f"{wav_stem}_slice{slice_idx}.wav"
-    audio_slice.export(tmp_path, format="wav")
-    result = model.transcribe(str(tmp_path), language=language, task="transcribe", beam_size=5)
+    # 切片各自独立解码（不依赖上一片文本），temperature 固定为 0 以避免噪声音频触发多次回退重解码
+    # 静音判定阈值与 GPU 路径的 is_silent 共用
+    # 该函数只在 CPU 上使用（CUDA 走 transcribe_file_pipelined），显式 fp16=False 以消除 whisper 的 CPU FP16 警告
+    result = model.transcribe(audio_slice, language=language, task="transcribe", beam_size=5,
+                              fp16=False,
+                              condition_on_previous_text=False,
+                              no_speech_threshold=NO_SPEECH_THRESHOLD,
+                              logprob_threshold=LOGPROB_THRESHOLD,
+                              compression_ratio_threshold=2.4,
+                              temperature=0.0)
     segments = result.get('segments', [])
     return segments
 
 
-def adjust_segments_for_overlap(segments, slice_start_ms, is_first_slice):
+def slice_mel(model, audio_slice: np.ndarray):
+    """
+    在 CPU 上计算整片的 log-mel，末尾补 N_SAMPLES 的静音，保证任意起始帧都能取满一个 30 秒窗口
+    """
+    return whisper.log_mel_spectrogram(audio_slice, n_mels=model.dims.n_mels, padding=N_SAMPLES)
+
+
+def segments_from_tokens(tokenizer, tokens, time_offset, window_duration):
     """
-    将片段时间戳调整为原始音频时间
-    并去掉重叠部分（非首片段开头的 OVERLAP）
+    将 model.decode 输出的 token 序列按时间戳 token 切成 whisper 风格的片段（与 whisper.transcribe 的规则一致）
+    返回 (segments, resume_s)：
+      - segments 的时间为相对于切片开头的秒数
+      - resume_s 为 None 表示整个窗口已处理完；否则最后一段被窗口截断，需从窗口内 resume_s 秒处继续 decode
     """
-    adjusted = []
-    offset = slice_start_ms / 1000  # 毫秒转秒
-    for seg in segments:
-        start, end = seg['start'] + offset, seg['end'] + offset
-        if not is_first_slice and start < offset + OVERLAP / 1000:
-            start = offset + OVERLAP / 1000
-            if start >= end:
-                continue
-        adjusted.append({'start': start, 'end': end, 'text': seg['text']})
-    return adjusted
+    ts_begin = tokenizer.timestamp_begin
+    tokens = [tok for tok in tokens if tok < tokenizer.eot or tok >= ts_begin]
+    is_ts = [tok >= ts_begin for tok in tokens]
+    single_timestamp_ending = is_ts[-2:] == [False, True]
+    # 连续两个时间戳处为片段边界，取第二个时间戳的位置
+    consecutive = [i for i in range(1, len(tokens)) if is_ts[i - 1] and is_ts[i]]
+
+    def text_of(seg_tokens):
+        return tokenizer.decode([tok for tok in seg_tokens if tok < ts_begin])
+
+    segments = []
+    if consecutive:
+        bounds = consecutive + [len(tokens)] if single_timestamp_ending else consecutive
+        last = 0
+        for cur in bounds:
+            seg_tokens = tokens[last:cur]
+            segments.append({
+                'start': time_offset + (seg_tokens[0] - ts_begin) * TIME_PRECISION,
+                'end': time_offset + (seg_tokens[-1] - ts_begin) * TIME_PRECISION,
+                'text': text_of(seg_tokens),
+            })
+            last = cur
+        # 末尾只剩一个时间戳（或未闭合的文本）说明最后一段被窗口截断，丢弃并从最后的时间戳处继续
+        resume_s = None if single_timestamp_ending else (tokens[last - 1] - ts_begin) * TIME_PRECISION
+    else:
+        timestamps = [tok for tok, ts in zip(tokens, is_ts) if ts]
+        duration = window_duration
+        if timestamps and timestamps[-1] != ts_begin:
+            duration = (timestamps[-1] - ts_begin) * TIME_PRECISION
+        segments.append({'start': time_offset, 'end': time_offset + duration, 'text': text_of(tokens)})
+        resume_s = None
+    segments = [seg for seg in segments if seg['text'].strip()]
+    return segments, resume_s
+
+
+def is_silent(result):
+    """与 whisper.transcribe 相同的静音判定：no_speech 概率高且解码置信度低的窗口直接跳过"""
+    return result.no_speech_prob > NO_SPEECH_THRESHOLD and result.avg_logprob < LOGPROB_THRESHOLD
+
+
+def decode_batch(model, mels, options):
+    """
+    批量 decode；显存不足时把批次对半拆开重试，直到单个窗口仍然放不下才抛出
+    """
+    try:
+        return model.decode(mels, options)
+    except torch.cuda.OutOfMemoryError:
+        if mels.shape[0] == 1:
+            raise
+        torch.cuda.empty_cache()
+        half = mels.shape[0] // 2
+        return decode_batch(model, mels[:half], options) + decode_batch(model, mels[half:], options)
+
+
+def transcribe_file_pipelined(model, audio: np.ndarray, language='ja', batch_size=DECODE_BATCH_SIZE):
+    """
+    GPU 流水线 + 批量 decode，返回 [(start_sample, segments), ...]，片段时间相对于各切片开头
+    每批最多 batch_size 个 30 秒 mel 窗口堆叠成 (N, n_mels, N_FRAMES)，一次 model.decode 完成
+    后台线程在 CPU 上提前计算后续切片的 mel，与当前批的 decode 重叠
+    与 whisper.transcribe 一样按最后的时间戳推进：被窗口截断的片段从截断处开窗，放入下一批继续 decode
+    """
+    tokenizer = whisper.tokenizer.get_tokenizer(
+        model.is_multilingual, num_languages=model.num_languages, language=language, task='transcribe'
+    )
+    options = whisper.DecodingOptions(language=language, task='transcribe', beam_size=5, fp16=True)
+    slices = list(slice_audio(audio))
+    n = len(slices)
+    mels = [None] * n  # 每片完整的 log-mel（CPU），切片处理完即释放
+    slice_segments = [[] for _ in slices]
+
+    def compute_mels(start, stop):
+        return start, [slice_mel(model, slices[idx][2]) for idx in range(start, stop)]
+
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = pool.submit(compute_mels, 0, min(batch_size, n)) if n else None
+        mel_ready = 0   # 已算好 mel 的切片数（按顺序）
+        next_slice = 0  # 下一个尚未开始 decode 的切片
+        carry = []      # 上一批中被截断、需要继续的窗口：(切片序号, 起始帧)
+        while carry or next_slice < n:
+            n_new = min(batch_size - len(carry), n - next_slice)
+            batch = carry + [(idx, 0) for idx in range(next_slice, next_slice + n_new)]
+            next_slice += n_new
+            carry = []
+            while mel_ready < next_slice:
+                start, computed = future.result()
+                mels[start:start + len(computed)] = computed
+                mel_ready = start + len(computed)
+                future = pool.submit(compute_mels, mel_ready, min(mel_ready + batch_size, n)) \
+                    if mel_ready < n else None
+
+            windows = [whisper.pad_or_trim(mels[idx][:, seek:seek + N_FRAMES], N_FRAMES) for idx, seek in batch]
+            batch_mels = torch.stack(windows).pin_memory().to(model.device, non_blocking=True).half()
+            results = decode_batch(model, batch_mels, options)
 
+            for (idx, seek), result in zip(batch, results):
+                content_frames = mels[idx].shape[-1] - N_FRAMES
+                next_seek = seek + N_FRAMES
+                if not is_silent(result):
+                    offset = seek * HOP_LENGTH / SAMPLE_RATE
+                    duration = min(N_FRAMES, content_frames - seek) * HOP_LENGTH / SAMPLE_RATE
+                    segments, resume_s = segments_from_tokens(tokenizer, result.tokens, offset, duration)
+                    slice_segments[idx].extend(segments)
+                    if resume_s:
+                        next_seek = seek + round(resume_s * SAMPLE_RATE / HOP_LENGTH)
+                if next_seek < content_frames:
+                    carry.append((idx, next_seek))
+                else:
+                    mels[idx] = None
 
-def transcribe_file(model, wav_path, language='ja'):
-    audio = AudioSegment.from_file(wav_path)
-    slices = slice_audio(audio)
-    all_segments = []
-    for i, (start_ms, end_ms, audio_slice_seg) in enumerate(slices):
-        segments = transcribe_slice(model, audio_slice_seg, i, wav_path.stem, language)
-        segments = adjust_segments_for_overlap(segments, start_ms, is_first_slice=(i == 0))
-        all_segments.extend(segments)
+    return [(start_sample, segments) for (start_sample, _, _), segments in zip(slices, slice_segments)]
+
+
+def adjust_overlap_soa(starts: np.ndarray, ends: np.ndarray, slice_start_s, is_first_slice):
+    """
+    将片段时间戳调整为原始音频时间，并去掉重叠部分（非首片段开头的 OVERLAP）
+    starts/ends 为切片内时间（秒），slice_start_s 为切片在原始音频中的起点（秒）
+    返回 (starts, ends, mask)，mask 为应保留的片段
+    """
+    starts = starts + slice_start_s
+    ends = ends + slice_start_s
+    if is_first_slice:
+        return starts, ends, np.ones(len(starts), dtype=bool)
+    starts = np.maximum(starts, slice_start_s + OVERLAP / 1000)
+    return starts, ends, starts < ends
+
+
+def adjust_segments_for_overlap(segments, slice_start_s, is_first_slice):
+    """
+    adjust_overlap_soa 的 dict 版本（向后兼容）：将片段时间戳调整为原始音频时间
+    并去掉重叠部分（非首片段开头的 OVERLAP），slice_start_s 为切片起点（秒）
+    """
+    starts = np.fromiter((seg['start'] for seg in segments), dtype=np.float64, count=len(segments))
+    ends = np.fromiter((seg['end'] for seg in segments), dtype=np.float64, count=len(segments))
+    starts, ends, mask = adjust_overlap_soa(starts, ends, slice_start_s, is_first_slice)
+    return [
+        {'start': start, 'end': end, 'text': seg['text']}
+        for start, end, keep, seg in zip(starts.tolist(), ends.tolist(), mask.tolist(), segments)
+        if keep
+    ]
+
+
+def join_slice_segments(slice_segments):
+    """
+    slice_segments: 按顺序的 [(start_sample, segments), ...]，片段时间相对于切片开头
+    只取 start/end/text 组成数组，逐片向量化调整时间、去掉重叠，最后一次性转回 dict
+    """
+    starts_all, ends_all, masks, texts = [], [], [], []
+    for i, (start_sample, segments) in enumerate(slice_segments):
+        starts = np.fromiter((seg['start'] for seg in segments), dtype=np.float64, count=len(segments))
+        ends = np.fromiter((seg['end'] for seg in segments), dtype=np.float64, count=len(segments))
+        starts, ends, mask = adjust_overlap_soa(starts, ends, start_sample / SAMPLE_RATE, is_first_slice=(i == 0))
+        starts_all.append(starts)
+        ends_all.append(ends)
+        masks.append(mask)
+        texts.extend(seg['text'] for seg in segments)
+    if not texts:
+        return []
+    mask = np.concatenate(masks)
+    starts = np.concatenate(starts_all)[mask]
+    ends = np.concatenate(ends_all)[mask]
+    texts = [text for text, keep in zip(texts, mask.tolist()) if keep]
+    return [
+        {'start': start, 'end': end, 'text': text}
+        for start, end, text in zip(starts.tolist(), ends.tolist(), texts)
+    ]
+
+
+def load_audio(wav_path):
+    """
+    一次性解码 wav 为 16kHz 单声道 float32 数组，后续切片直接在数组上索引
+    """
+    audio, sr = soundfile.read(str(wav_path), dtype='float32', always_2d=False)
+    if audio.ndim > 1:
+        audio = audio.mean(axis=1)
+    if sr != SAMPLE_RATE:
+        g = gcd(sr, SAMPLE_RATE)
+        audio = resample_poly(audio, SAMPLE_RATE // g, sr // g).astype(np.float32)
+    return audio
+
+
+def transcribe_file(model, wav_path, language='ja', batch_size=DECODE_BATCH_SIZE):
+    audio = load_audio(wav_path)
+    if model.device.type == 'cuda':
+        slice_segments = transcribe_file_pipelined(model, audio, language, batch_size)
+    else:
+        slice_segments = [
+            (start_sample, transcribe_slice(model, audio_slice, language))
+            for start_sample, _, audio_slice in slice_audio(audio)
+        ]
+    all_segments = join_slice_segments(slice_segments)
     all_segments = merge_short_segments(all_segments)
     return all_segments
 
 
+def positive_int(value):
+    """argparse 类型：只接受 >= 1 的整数"""
+    n = int(value)
+    if n < 1:
+        raise argparse.ArgumentTypeError(f'must be >= 1, got {value}')
+    return n
+
+
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument('--device', default='cpu', help="'cpu' 或 'cuda'")
     parser.add_argument('--model', default='large-v3', help='Whisper 模型')
+    parser.add_argument('--batch-size', type=positive_int, default=DECODE_BATCH_SIZE,
+                        help='GPU 上每次 decode 的 30 秒窗口数，显存不足时会自动减半重试')
     args = parser.parse_args()
 
     SCRIPT_DIR.mkdir(parents=True, exist_ok=True)
@@ -120,6 +343,8 @@ def main():
 
     print(f"loading Whisper model {args.model} on {args.device} ...")
     model = whisper.load_model(args.model, device=args.device)
+    if model.device.type == 'cuda':
+        model = to_fp16(model)
 
     wavs = sorted(INPUT_DIR.glob('*.wav'))
     if not wavs:
@@ -127,15 +352,11 @@ def main():
         return
 
     for wav in tqdm(wavs, desc='transcribing wavs'):
-        segments = transcribe_file(model, wav, language='ja')
+        segments = transcribe_file(model, wav, language='ja', batch_size=args.batch_size)
         out_vtt = SCRIPT_DIR / (wav.stem + '.vtt')
         write_vtt_from_segments(out_vtt, segments)
         print(f'written {out_vtt}')
 
-        # 清理 temp 文件夹
-        if TEMP_DIR.exists():
-            shutil.rmtree(TEMP_DIR)
-
     print('\nAll done. Whisper transcription complete.')
 
 